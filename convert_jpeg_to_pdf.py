@@ -1,11 +1,94 @@
+import asyncio
+import logging
 import os
-import shutil
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from PIL import Image
+import img2pdf
 import sys
 
+from copy_utils import reflink_copy
 
-def convert_images_to_pdfs():
-    """Convert all JPEG images from raws folder to PDF files in published folder."""
+logger = logging.getLogger(__name__)
+
+# Page size for generated PDFs, matching Pillow's resolution=100.0
+_PDF_LAYOUT = img2pdf.get_fixed_dpi_layout_fun((100, 100))
+
+# Images img2pdf can't embed directly but Pillow can still convert
+_IMG2PDF_UNSUPPORTED = (
+    img2pdf.AlphaChannelError,
+    img2pdf.ExifOrientationError,
+    img2pdf.JpegColorspaceError,
+    img2pdf.UnsupportedColorspaceError,
+)
+
+
+def _convert_one(source_path, destination_path):
+    """Convert a single JPEG to PDF. Returns an error message on failure.
+
+    The PDF is written to a temporary file and moved into place, so an
+    existing destination that is a hardlink to an original is replaced
+    rather than overwritten through the link.
+    """
+    temp_path = destination_path + ".tmp"
+    try:
+        # Embed the JPEG stream as-is, without decoding and re-encoding it
+        try:
+            pdf_bytes = img2pdf.convert(source_path, layout_fun=_PDF_LAYOUT)
+            with open(temp_path, 'wb') as f:
+                f.write(pdf_bytes)
+            os.replace(temp_path, destination_path)
+            return None
+        except _IMG2PDF_UNSUPPORTED:
+            # img2pdf refuses some images it can read (transparency, mirrored
+            # EXIF orientation, unusual colorspaces); let Pillow convert them
+            pass
+
+        # Open and process the image
+        with Image.open(source_path) as img:
+            # Convert to RGB if necessary (in case of RGBA or other formats)
+            if img.mode != 'RGB':
+                img = img.convert('RGB')
+
+            # Save as PDF
+            img.save(temp_path, 'PDF', resolution=100.0)
+
+        os.replace(temp_path, destination_path)
+        return None
+
+    except Exception as e:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return str(e)
+
+
+async def convert_one_async(source_path, destination_path, semaphore):
+    """Convert a single JPEG to PDF in a worker thread."""
+    async with semaphore:
+        return await asyncio.to_thread(_convert_one, source_path,
+                                       destination_path)
+
+
+async def convert_all_async(source_paths, destination_paths):
+    """Convert JPEGs to PDFs on worker threads without blocking the event loop.
+
+    Returns an error message (or None) per file, in order.
+    """
+    semaphore = asyncio.Semaphore(os.cpu_count())
+    return await asyncio.gather(
+        *(convert_one_async(source_path, destination_path, semaphore)
+          for source_path, destination_path in zip(source_paths,
+                                                   destination_paths))
+    )
+
+
+def convert_images_to_pdfs(use_threads=False):
+    """Convert all JPEG images from raws folder to PDF files in published folder.
+
+    Conversions run in a process pool since Pillow decode/encode is CPU-bound;
+    pass use_threads=True to run them on threads via asyncio instead, which
+    avoids process startup cost on small batches (Pillow releases the GIL
+    around its codecs).
+    """
 
     # Define source and destination folders
     source_folder = "receipts/renamed"
@@ -23,9 +106,13 @@ def convert_images_to_pdfs():
 
     # Get all JPEG files from source folder
     jpeg_files = []
-    for filename in os.listdir(source_folder):
-        if filename.lower().endswith(('.jpeg', '.jpg')):
-            jpeg_files.append(filename)
+    source_paths = []
+    with os.scandir(source_folder) as entries:
+        for entry in entries:
+            if (entry.is_file() and
+                    entry.name.lower().endswith(('.jpeg', '.jpg'))):
+                jpeg_files.append(entry.name)
+                source_paths.append(entry.path)
 
     if not jpeg_files:
         print(f"No JPEG files found in '{source_folder}' folder")
@@ -33,33 +120,34 @@ def convert_images_to_pdfs():
 
     print(f"Found {len(jpeg_files)} JPEG files to convert to PDF")
 
-    # Process each JPEG file
-    successful_conversions = 0
-    failed_conversions = 0
-
+    # Build destination paths (replace .jpg/.jpeg with .pdf)
+    destination_paths = []
+    pdf_filenames = []
     for filename in jpeg_files:
-        source_path = os.path.join(source_folder, filename)
-
-        # Create PDF filename (replace .jpg/.jpeg with .pdf)
         base_name = os.path.splitext(filename)[0]
         pdf_filename = f"{base_name}.pdf"
-        destination_path = os.path.join(destination_folder, pdf_filename)
+        destination_paths.append(os.path.join(destination_folder, pdf_filename))
+        pdf_filenames.append(pdf_filename)
 
-        try:
-            # Open and process the image
-            with Image.open(source_path) as img:
-                # Convert to RGB if necessary (in case of RGBA or other formats)
-                if img.mode != 'RGB':
-                    img = img.convert('RGB')
+    # Convert the JPEG files in parallel
+    if use_threads:
+        errors = asyncio.run(convert_all_async(source_paths,
+                                               destination_paths))
+    else:
+        with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+            errors = list(executor.map(_convert_one, source_paths,
+                                       destination_paths, chunksize=4))
 
-                # Save as PDF
-                img.save(destination_path, 'PDF', resolution=100.0)
+    successful_conversions = 0
+    failed_conversions = 0
 
-            print("✓ Converted: " + filename + " → " + pdf_filename)
+    for filename, pdf_filename, error in zip(jpeg_files, pdf_filenames,
+                                             errors):
+        if error is None:
+            logger.info("✓ Converted: " + filename + " → " + pdf_filename)
             successful_conversions += 1
-
-        except Exception as e:
-            print(f"✗ Failed to convert {filename}: {e}")
+        else:
+            logger.error(f"✗ Failed to convert {filename}: {error}")
             failed_conversions += 1
 
     # Summary
@@ -74,6 +162,16 @@ def convert_images_to_pdfs():
     return successful_conversions > 0
 
 
+def _copy_one(source_path, destination_path):
+    """Copy a single file. Returns an error message on failure."""
+    try:
+        reflink_copy(source_path, destination_path)
+        return None
+
+    except Exception as e:
+        return str(e)
+
+
 def copy_images_to_published():
     """Simple copy all JPEG images from raws folder to published folder."""
 
@@ -93,9 +191,13 @@ def copy_images_to_published():
 
     # Get all JPEG files from source folder
     jpeg_files = []
-    for filename in os.listdir(source_folder):
-        if filename.lower().endswith(('.jpeg', '.jpg')):
-            jpeg_files.append(filename)
+    source_paths = []
+    with os.scandir(source_folder) as entries:
+        for entry in entries:
+            if (entry.is_file() and
+                    entry.name.lower().endswith(('.jpeg', '.jpg'))):
+                jpeg_files.append(entry.name)
+                source_paths.append(entry.path)
 
     if not jpeg_files:
         print(f"No JPEG files found in '{source_folder}' folder")
@@ -103,22 +205,22 @@ def copy_images_to_published():
 
     print(f"Found {len(jpeg_files)} JPEG files to copy")
 
-    # Copy each JPEG file
+    # Copy the JPEG files in parallel; copying is I/O-bound so threads suffice
+    destination_paths = [os.path.join(destination_folder, filename)
+                         for filename in jpeg_files]
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        errors = list(executor.map(_copy_one, source_paths,
+                                   destination_paths))
+
     successful_copies = 0
     failed_copies = 0
 
-    for filename in jpeg_files:
-        source_path = os.path.join(source_folder, filename)
-        destination_path = os.path.join(destination_folder, filename)
-
-        try:
-            # Copy the file
-            shutil.copy2(source_path, destination_path)
-            print("✓ Copied: " + filename)
+    for filename, error in zip(jpeg_files, errors):
+        if error is None:
+            logger.info("✓ Copied: " + filename)
             successful_copies += 1
-
-        except Exception as e:
-            print(f"✗ Failed to copy {filename}: {e}")
+        else:
+            logger.error(f"✗ Failed to copy {filename}: {error}")
             failed_copies += 1
 
     # Summary
@@ -134,6 +236,9 @@ def copy_images_to_published():
 
 
 if __name__ == "__main__":
+    logging.basicConfig(format="%(message)s", stream=sys.stdout)
+    logger.setLevel(logging.INFO)
+
     print("JPEG to PDF Converter")
     print("====================")
 
@@ -143,7 +248,7 @@ if __name__ == "__main__":
         success = copy_images_to_published()
     else:
         print("Mode: Convert JPEG to PDF (use --copy for simple copy)")
-        success = convert_images_to_pdfs()
+        success = convert_images_to_pdfs(use_threads="--threads" in sys.argv)
 
     if success:
         print("\n✅ Processing completed successfully!")
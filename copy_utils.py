@@ -0,0 +1,76 @@
+"""
+File copying helpers for the BFF PCEF Expense Reporter scripts. Copies are
+made as copy-on-write clones where the filesystem allows, so duplicating a
+receipt costs no extra disk space or I/O. Hardlinks are available on request
+but share data with the original, so editing either edits both.
+"""
+
+import errno
+import os
+import shutil
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows
+    fcntl = None
+
+# Linux ioctl request for a copy-on-write clone (reflink) of a whole file
+FICLONE = 0x40049409
+
+# Ways to duplicate a file, cheapest first
+COPY_MODES = ("link", "reflink", "copy")
+
+# os.link errors meaning hardlinks can't be made here (another filesystem,
+# no link support, too many links), so a copy should be made instead
+_LINK_UNSUPPORTED_ERRNOS = {errno.EXDEV, errno.EPERM, errno.ENOTSUP,
+                            errno.EOPNOTSUPP, errno.EMLINK}
+
+
+def reflink_copy(source_path, destination_path):
+    """Copy a file, cloning it copy-on-write when the filesystem supports it."""
+    # Opening the destination truncates it, which would wipe the source if
+    # both names refer to the same file (e.g. a hardlink); shutil.copy2
+    # refuses this case the same way
+    if (os.path.exists(destination_path) and
+            os.path.samefile(source_path, destination_path)):
+        raise shutil.SameFileError(f"{source_path!r} and "
+                                   f"{destination_path!r} are the same file")
+
+    if fcntl is not None:
+        try:
+            with open(source_path, 'rb') as src, \
+                    open(destination_path, 'wb') as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            shutil.copystat(source_path, destination_path)
+            return
+        except OSError:
+            # Not supported here (e.g. ext4, cross-device); copy normally
+            pass
+
+    shutil.copy2(source_path, destination_path)
+
+
+def link_or_copy(source_path, destination_path, mode="reflink"):
+    """Duplicate a file using the given COPY_MODES entry.
+
+    "reflink" clones the file copy-on-write, falling back to a plain copy.
+    "link" hardlinks the file (falling back to a reflink when the destination
+    is on another filesystem); writes through either name change both.
+    """
+    if mode == "link":
+        try:
+            os.link(source_path, destination_path)
+            return
+        except OSError as e:
+            # Other errors (e.g. the destination already exists) are real
+            # failures, not a reason to copy over the destination
+            if e.errno not in _LINK_UNSUPPORTED_ERRNOS:
+                raise
+            mode = "reflink"
+
+    if mode == "reflink":
+        reflink_copy(source_path, destination_path)
+    elif mode == "copy":
+        shutil.copy2(source_path, destination_path)
+    else:
+        raise ValueError(f"Unknown copy mode: {mode}")
@@ -1,17 +1,75 @@
+import asyncio
 import csv
+import json
+import logging
 import re
 import os
+import sys
 from datetime import datetime
 from pathlib import Path
-from openai import OpenAI
-from dotenv import load_dotenv
 import uuid
 
-# Load environment variables
-load_dotenv()
+from llm_client import close_async_client, get_async_client
+from receipt_dates import find_receipt_date
 
-# Initialize OpenAI client
-client = OpenAI(api_key=os.getenv('OPEN_API_DEV_KEY'))
+logger = logging.getLogger(__name__)
+
+# Cap on in-flight categorization requests to stay under the OpenAI RPM limit
+MAX_CONCURRENT_REQUESTS = int(os.getenv("OAI_CONCURRENCY", "20"))
+
+# Number of expenses classified per categorization request
+CATEGORY_BATCH_SIZE = 20
+
+# Report CSV write buffer size and how often buffered rows are synced to disk
+CSV_BUFFER_SIZE = 1 << 20
+FSYNC_EVERY_ROWS = 50
+
+# Categories from previous runs keyed by normalized vendor and notes
+CATEGORY_CACHE_FILE = Path(__file__).parent / "category_cache.json"
+
+# Available expense categories
+CATEGORIES = (
+    "Personnel",
+    "Travel",
+    "Contracts",
+    "Materials",
+    "Overhead",
+    "Fiscal sponsor fee",
+    "Other"
+)
+
+# Metadata file field patterns
+_META_RE = re.compile(r'^(Vendor|Date|Total|Notes):[ \t]*(.+?)[ \t]*$',
+                      re.MULTILINE)
+_AMOUNT_RE = re.compile(r'\$?([\d,]+\.?\d*)')
+
+
+def load_category_cache():
+    """Load cached categories from previous runs."""
+    if not CATEGORY_CACHE_FILE.exists():
+        return {}
+    try:
+        with open(CATEGORY_CACHE_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except Exception as e:
+        logger.warning(f"Ignoring unreadable category cache: {e}")
+        return {}
+
+
+def save_category_cache(category_cache):
+    """Write the category cache so later runs can reuse it."""
+    try:
+        tmp_file = CATEGORY_CACHE_FILE.with_suffix('.tmp')
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(category_cache, f, indent=2, sort_keys=True)
+        os.replace(tmp_file, CATEGORY_CACHE_FILE)
+    except Exception as e:
+        logger.warning(f"Could not save category cache: {e}")
+
+
+def category_cache_key(vendor, notes):
+    """Normalize vendor and notes into a category cache key."""
+    return f"{vendor.lower().strip()}\n{(notes or '').lower().strip()[:200]}"
 
 
 def parse_metadata_file(metadata_file_path):
@@ -20,23 +78,17 @@ def parse_metadata_file(metadata_file_path):
         with open(metadata_file_path, 'r', encoding='utf-8') as f:
             content = f.read()
 
-        # Extract vendor
-        vendor_match = re.search(r'Vendor:\s*(.+?)(?:\n|$)', content)
-        vendor = vendor_match.group(1).strip(
-        ) if vendor_match else "Not specified"
+        fields = dict(_META_RE.findall(content))
 
-        # Extract date
-        date_match = re.search(r'Date:\s*(.+?)(?:\n|$)', content)
-        date_str = date_match.group(1).strip() if date_match else ""
+        vendor = fields.get('Vendor', "Not specified")
+        date_str = fields.get('Date', "")
 
         # Extract total amount
-        total_match = re.search(r'Total:\s*\$?([\d,]+\.?\d*)', content)
+        total_match = _AMOUNT_RE.match(fields.get('Total', ""))
         total = total_match.group(1).replace(
             ',', '') if total_match else "0.00"
 
-        # Extract notes
-        notes_match = re.search(r'Notes:\s*(.+?)(?:\n|$)', content)
-        notes = notes_match.group(1).strip() if notes_match else ""
+        notes = fields.get('Notes', "")
 
         return {
             'vendor': vendor,
@@ -45,7 +97,7 @@ def parse_metadata_file(metadata_file_path):
             'notes': notes
         }
     except Exception as e:
-        print(f"Error parsing {metadata_file_path}: {e}")
+        logger.error(f"Error parsing {metadata_file_path}: {e}")
         return {
             'vendor': "Error parsing",
             'date': "",
@@ -54,22 +106,14 @@ def parse_metadata_file(metadata_file_path):
         }
 
 
-def determine_category(vendor, notes, filename):
-    """Determine the expense category using GPT-5 for intelligent categorization."""
-    # Define the available categories
-    categories = [
-        "Personnel",
-        "Travel",
-        "Contracts",
-        "Materials",
-        "Overhead",
-        "Fiscal sponsor fee",
-        "Other"
-    ]
+async def determine_category_async(vendor, notes, filename, semaphore):
+    """Determine the expense category using GPT-5 for intelligent categorization.
 
+    Returns None if the API call fails so the default is not cached.
+    """
     # Prepare the prompt for GPT-5
     prompt = f"""Categorize this expense into one of the following categories:
-{', '.join(categories)}
+{', '.join(CATEGORIES)}
 
 Expense details:
 - Vendor: {vendor}
@@ -81,33 +125,192 @@ Do not include any explanation or additional text."""
 
     try:
         # Call GPT-5 for categorization
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system",
-                 "content": "You are an expert financial analyst who categorizes "
-                 "business expenses accurately and consistently."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.1,  # Low temperature for consistent categorization
-            max_tokens=10
-        )
+        async with semaphore:
+            response = await get_async_client().chat.completions.create(
+                model="gpt-4o",
+                messages=[
+                    {"role": "system",
+                     "content": "You are an expert financial analyst who "
+                     "categorizes business expenses accurately and "
+                     "consistently."},
+                    {"role": "user", "content": prompt}
+                ],
+                temperature=0.1,  # Low temperature for consistent categorization
+                max_tokens=10
+            )
 
         # Extract the category from the response
         category = response.choices[0].message.content.strip()
 
         # Validate that the response is one of our expected categories
-        if category in categories:
+        if category in CATEGORIES:
             return category
         else:
-            print(f"Warning: GPT returned unexpected category '{category}' "
-                  f"for vendor '{vendor}'. Defaulting to 'Other'.")
+            logger.warning(f"GPT returned unexpected category "
+                           f"'{category}' for vendor '{vendor}'. "
+                           f"Defaulting to 'Other'.")
             return "Other"
 
     except Exception as e:
-        print(
+        logger.error(
             f"Error calling GPT API for vendor '{vendor}': {e}. Defaulting to 'Other'.")
-        return "Other"
+        return None
+
+
+async def determine_categories_batch(expenses, semaphore):
+    """Categorize a list of (renamed_file, metadata) pairs in one GPT request.
+
+    Falls back to one request per expense if the response cannot be parsed.
+    """
+    expense_lines = "\n".join(
+        f"{i}. vendor={metadata['vendor']}, notes={metadata['notes']}, "
+        f"filename={renamed_file}"
+        for i, (renamed_file, metadata) in enumerate(expenses, start=1))
+
+    prompt = f"""Classify each numbered expense into one of the following categories:
+{', '.join(CATEGORIES)}
+
+Expenses:
+{expense_lines}
+
+Respond with ONLY a JSON list of category names, one per expense, in order.
+Do not include any explanation or additional text."""
+
+    try:
+        async with semaphore:
+            response = await get_async_client().chat.completions.create(
+                model="gpt-4o",
+                messages=[
+                    {"role": "system",
+                     "content": "You are an expert financial analyst who "
+                     "categorizes business expenses accurately and "
+                     "consistently."},
+                    {"role": "user", "content": prompt}
+                ],
+                temperature=0.1,  # Low temperature for consistent categorization
+                max_tokens=10 * len(expenses)
+            )
+
+        # Extract the JSON list from the response, ignoring any code fence
+        content = response.choices[0].message.content
+        categories = json.loads(content[content.find('['):
+                                        content.rfind(']') + 1])
+        if not isinstance(categories, list) or len(categories) != len(expenses):
+            raise ValueError(f"expected {len(expenses)} categories, "
+                             f"got {content!r}")
+
+    except Exception as e:
+        logger.warning(f"Batch categorization failed ({e}). "
+                       f"Retrying {len(expenses)} expenses individually.")
+        return await asyncio.gather(
+            *(determine_category_async(metadata['vendor'], metadata['notes'],
+                                       renamed_file, semaphore)
+              for renamed_file, metadata in expenses))
+
+    # Validate that each response is one of our expected categories
+    for i, ((renamed_file, metadata), category) in enumerate(
+            zip(expenses, categories)):
+        if category not in CATEGORIES:
+            logger.warning(f"GPT returned unexpected category "
+                           f"'{category}' for vendor '{metadata['vendor']}'. "
+                           f"Defaulting to 'Other'.")
+            categories[i] = "Other"
+    return categories
+
+
+async def categorize_batch(batch_keys, batch, semaphore):
+    """Categorize one batch, returning its cache keys alongside the results."""
+    try:
+        categories = await determine_categories_batch(batch, semaphore)
+    except Exception as e:
+        logger.error(f"Error categorizing {len(batch)} expenses: {e}. "
+                     f"Defaulting to 'Other'.")
+        categories = [None] * len(batch)
+    return batch_keys, categories
+
+
+def build_expense_row(renamed_file, metadata, category):
+    """Build an expense report CSV row."""
+    # Create expense description
+    if metadata['notes'] and metadata['notes'] != "None":
+        description = metadata['notes']
+    else:
+        description = f"Purchase from {metadata['vendor']}"
+
+    # Format date
+    formatted_date = format_date(metadata['date'])
+
+    return [
+        category,
+        description,
+        metadata['vendor'],
+        'Receipt',
+        formatted_date,
+        f"${metadata['total']}",
+        renamed_file
+    ]
+
+
+async def write_expense_rows(expenses, writer, csvfile, category_cache):
+    """Categorize (renamed_file, metadata) pairs and write their rows in order.
+
+    Rows are written as soon as every earlier row's category is known, so CSV
+    output overlaps with the remaining API requests. New categories are added
+    to category_cache.
+    """
+    # Only send each uncached vendor/notes combination to GPT once
+    keys = [category_cache_key(metadata['vendor'], metadata['notes'])
+            for _, metadata in expenses]
+    pending = {}
+    for key, expense in zip(keys, expenses):
+        if key not in category_cache and key not in pending:
+            pending[key] = expense
+    print(f"Categorizing {len(pending)} of {len(expenses)} expenses "
+          f"(the rest are cached or repeated)")
+
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    pending_keys = list(pending)
+    pending_expenses = list(pending.values())
+    batches = [
+        categorize_batch(pending_keys[i:i + CATEGORY_BATCH_SIZE],
+                         pending_expenses[i:i + CATEGORY_BATCH_SIZE],
+                         semaphore)
+        for i in range(0, len(pending_expenses), CATEGORY_BATCH_SIZE)
+    ]
+
+    next_row = 0
+
+    def write_ready_rows():
+        """Write rows, in order, up to the first one still awaiting a category."""
+        nonlocal next_row
+        while next_row < len(expenses) and keys[next_row] not in pending:
+            renamed_file, metadata = expenses[next_row]
+            category = category_cache.get(keys[next_row], "Other")
+            writer.writerow(build_expense_row(renamed_file, metadata,
+                                              category))
+            next_row += 1
+            if next_row % FSYNC_EVERY_ROWS == 0:
+                csvfile.flush()
+                os.fsync(csvfile.fileno())
+
+    write_ready_rows()
+    for batch in asyncio.as_completed(batches):
+        batch_keys, categories = await batch
+        for key, category in zip(batch_keys, categories):
+            if category is not None:
+                category_cache[key] = category
+            del pending[key]
+        write_ready_rows()
+
+
+async def run_categorization(expenses, writer, csvfile, category_cache):
+    """Write categorized expense rows, then close the HTTP connection pool."""
+    # Fail fast if the API key is missing
+    get_async_client()
+    try:
+        await write_expense_rows(expenses, writer, csvfile, category_cache)
+    finally:
+        await close_async_client()
 
 
 def format_date(date_str):
@@ -115,38 +318,11 @@ def format_date(date_str):
     if not date_str:
         return ""
 
-    # Try to parse various date formats
-    date_patterns = [
-        r'(\w+)\s+(\d{1,2}),?\s+(\d{4})',  # July 9, 2025 or July 9 2025
-        r'(\d{1,2})/(\d{1,2})/(\d{4})',   # 07/01/25
-        r'(\d{1,2})-(\d{1,2})-(\d{4})',   # 07-01-2025
-    ]
+    parsed_date = find_receipt_date(date_str)
+    if parsed_date is None:
+        return date_str
 
-    for pattern in date_patterns:
-        match = re.search(pattern, date_str)
-        if match:
-            if pattern == date_patterns[0]:  # Month name format
-                month_name = match.group(1)
-                day = match.group(2)
-                year = match.group(3)
-                # Convert month name to number
-                month_names = {
-                    'january': '01', 'february': '02', 'march': '03', 'april': '04',
-                    'may': '05', 'june': '06', 'july': '07', 'august': '08',
-                    'september': '09', 'october': '10', 'november': '11', 'december': '12'
-                }
-                month = month_names.get(month_name.lower(), '01')
-            else:  # Numeric format
-                month = match.group(1).zfill(2)
-                day = match.group(2).zfill(2)
-                year = match.group(3)
-                # Handle 2-digit years
-                if len(year) == 2:
-                    year = '20' + year
-
-            return f"{month}/{day}/{year}"
-
-    return date_str
+    return parsed_date.strftime("%m/%d/%Y")
 
 
 def generate_expense_report():
@@ -186,51 +362,37 @@ def generate_expense_report():
         'SOURCE IMAGE FILE'
     ]
 
-    # Generate CSV
-    with open(output_file, 'w', newline='', encoding='utf-8') as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerow(headers)
-
-        # Process each renamed file
-        for renamed_file in sorted(file_mapping.keys()):
-            metadata_filename = file_mapping[renamed_file]
-            metadata_path = base_dir / "receipts" / metadata_filename
-
-            if not metadata_path.exists():
-                print(f"Warning: Metadata file not found: {metadata_filename}")
-                continue
-
-            # Parse metadata
-            metadata = parse_metadata_file(metadata_path)
-
-            # Determine category
-            category = determine_category(
-                metadata['vendor'], metadata['notes'], renamed_file)
-
-            # Create expense description
-            if metadata['notes'] and metadata['notes'] != "None":
-                description = metadata['notes']
-            else:
-                description = f"Purchase from {metadata['vendor']}"
-
-            # Format date
-            formatted_date = format_date(metadata['date'])
-
-            # Write row
-            row = [
-                category,
-                description,
-                metadata['vendor'],
-                'Receipt',
-                formatted_date,
-                f"${metadata['total']}",
-                renamed_file
-            ]
-            writer.writerow(row)
+    # Parse metadata for each renamed file
+    expenses = []
+    for renamed_file in sorted(file_mapping.keys()):
+        metadata_filename = file_mapping[renamed_file]
+        metadata_path = base_dir / "receipts" / metadata_filename
+
+        if not metadata_path.exists():
+            logger.warning(f"Metadata file not found: {metadata_filename}")
+            continue
+
+        expenses.append((renamed_file, parse_metadata_file(metadata_path)))
+
+    # Generate CSV, writing rows as their categories arrive
+    category_cache = load_category_cache()
+    try:
+        with open(output_file, 'w', newline='', encoding='utf-8',
+                  buffering=CSV_BUFFER_SIZE) as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(headers)
+
+            asyncio.run(run_categorization(expenses, writer, csvfile,
+                                           category_cache))
+    finally:
+        # Keep the categories found so far, even if the run was interrupted
+        save_category_cache(category_cache)
 
     print(f"Expense report generated successfully: {output_file}")
     print(f"Processed {len(file_mapping)} files")
 
 
 if __name__ == "__main__":
+    logging.basicConfig(format="%(message)s", stream=sys.stdout)
+    logger.setLevel(logging.INFO)
     generate_expense_report()
@@ -0,0 +1,63 @@
+"""
+Shared OpenAI client for the BFF PCEF Expense Reporter scripts. The client
+is created on first use so that importing a script does not require the
+API key, and so that extraction and categorization share one connection
+pool when run in the same process.
+"""
+
+import functools
+import os
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI
+
+# Retries for rate-limited (429), timed-out and 5xx requests; the SDK backs
+# off exponentially between attempts and honors Retry-After
+MAX_RETRIES = 5
+
+# Fail a stalled request after a minute instead of the SDK's ten-minute
+# default, so the retries above kick in
+REQUEST_TIMEOUT_SECONDS = 60.0
+CONNECT_TIMEOUT_SECONDS = 10.0
+
+
+@functools.lru_cache(maxsize=1)
+def get_async_client() -> "AsyncOpenAI":
+    """Return the shared async OpenAI client, creating it on first call."""
+    # Imported here since openai takes several hundred ms to import
+    import httpx
+    from dotenv import load_dotenv
+    from openai import AsyncOpenAI, DefaultAioHttpClient
+
+    # Load environment variables from .env file
+    load_dotenv()
+
+    # Check if API key is set
+    api_key = os.getenv("OPEN_API_DEV_KEY")
+    if not api_key:
+        raise ValueError(
+            "OPEN_API_DEV_KEY environment variable is not set. "
+            "Please run 'python setup_env.py' or set the environment variable "
+            "manually."
+        )
+
+    # Use the aiohttp transport, which keeps scaling past the concurrency
+    # where the default httpx transport plateaus
+    return AsyncOpenAI(
+        api_key=api_key,
+        max_retries=MAX_RETRIES,
+        timeout=httpx.Timeout(REQUEST_TIMEOUT_SECONDS,
+                              connect=CONNECT_TIMEOUT_SECONDS),
+        http_client=DefaultAioHttpClient(
+            limits=httpx.Limits(max_connections=100,
+                                max_keepalive_connections=100)
+        )
+    )
+
+
+async def close_async_client():
+    """Close the shared client's connection pool if it was created."""
+    if get_async_client.cache_info().currsize:
+        await get_async_client().close()
+        get_async_client.cache_clear()
@@ -1,30 +1,68 @@
 import os
-from openai import OpenAI
+import asyncio
 import base64
-from datetime import datetime
-import shutil
 import re
-from dotenv import load_dotenv
-import fitz  # PyMuPDF for PDF processing
+from PIL import Image, ImageOps
+import collections
 import csv
+import functools
+import hashlib
+import io
+import json
+import logging
+import mmap
+import sys
+
+from copy_utils import COPY_MODES, link_or_copy
+from llm_client import close_async_client, get_async_client
+from receipt_dates import parse_receipt_date
+
+try:
+    import orjson
+except ImportError:  # Fall back to the standard library json module
+    orjson = None
+
+try:
+    import pybase64
+except ImportError:  # Fall back to the standard library base64 module
+    pybase64 = None
+
+logger = logging.getLogger(__name__)
 
-# Load environment variables from .env file
-load_dotenv()
+# Folder containing the receipt images
+FOLDER_PATH = "receipts"  # change to your actual folder path
 
-# Check if API key is set
-api_key = os.getenv("OPEN_API_DEV_KEY")
-if not api_key:
-    raise ValueError(
-        "OPEN_API_DEV_KEY environment variable is not set. "
-        "Please run 'python setup_env.py' or set the environment variable "
-        "manually."
-    )
+# How renamed copies are made (see copy_utils.COPY_MODES). A reflink is a
+# free copy-on-write clone where supported and a real copy elsewhere; "link"
+# shares data with the original, so in-place edits would alter it too
+RENAMED_COPY_MODE = "reflink"
 
-# Initialize OpenAI client
-client = OpenAI(api_key=api_key)
+# Document types sent to the Vision API
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff')
+SUPPORTED_EXTENSIONS = IMAGE_EXTENSIONS + ('.pdf',)
 
-# Folder containing the receipt images
-FOLDER_PATH = "receipts"  # change to your actual folder path
+# Cap on in-flight Vision API requests to stay under the OpenAI RPM limit
+MAX_CONCURRENT_REQUESTS = int(os.getenv("OAI_CONCURRENCY", "20"))
+
+# Longest edge, in pixels, of images sent to the Vision API; larger photos
+# only cost more tiles without improving extraction
+MAX_IMAGE_DIMENSION = 1568
+
+# Summary CSV columns, one SummaryRow per document
+SUMMARY_CSV_HEADERS = ('Original Filename', 'Renamed Filename',
+                       'Metadata Filename')
+SummaryRow = collections.namedtuple('SummaryRow',
+                                    'original renamed metadata')
+
+# Summary CSV write buffer size
+CSV_BUFFER_SIZE = 1 << 20
+
+# Manifest of previously extracted text keyed by document content hash
+CACHE_FILENAME = ".cache.json"
+
+# Batch API polling settings
+BATCH_POLL_INTERVAL_SECONDS = 30
+BATCH_TERMINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
 
 # Define the prompt for receipt extraction
 EXTRACTION_PROMPT = (
@@ -32,101 +70,133 @@ EXTRACTION_PROMPT = (
     "- Vendor/store name (the business that issued the receipt)\n"
     "- Total cost (currency and amount)\n"
     "- Date of purchase\n"
-    "- Any handwritten notes or markings\n\n"
-    "Format the result as:\n"
-    "Vendor: <vendor/store name>\nDate: <date>\nTotal: <amount>\n"
-    "Notes: <handwritten notes or 'None'>"
+    "- Any handwritten notes or markings, or 'None'"
 )
 
+# Asks for several receipts at once; used when sending documents in groups
+GROUP_EXTRACTION_PROMPT = (
+    "Each of the {count} images is a separate receipt. For each receipt, in "
+    "the order the images are given, extract:\n"
+    "- idx: the image's position, counting from 0 for the first image\n"
+    "- vendor: vendor/store name (the business that issued the receipt)\n"
+    "- total: total cost (currency and amount)\n"
+    "- date: date of purchase\n"
+    "- notes: any handwritten notes or markings, or 'None'\n\n"
+    "Return one entry per receipt in the receipts list."
+)
 
+# Structured output schema the Vision API replies must follow
+_RECEIPT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "vendor": {"type": "string"},
+        "date": {"type": "string"},
+        "total": {"type": "string"},
+        "notes": {"type": "string"},
+    },
+    "required": ["vendor", "date", "total", "notes"],
+    "additionalProperties": False,
+}
+# Grouped replies also echo each image's position, so that entries can be
+# matched to documents even if the model reorders them
+_GROUP_RECEIPT_SCHEMA = {
+    **_RECEIPT_SCHEMA,
+    "properties": {"idx": {"type": "integer"},
+                   **_RECEIPT_SCHEMA["properties"]},
+    "required": ["idx", *_RECEIPT_SCHEMA["required"]],
+}
+RECEIPT_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {"name": "receipt", "strict": True,
+                    "schema": _RECEIPT_SCHEMA},
+}
+GROUP_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "receipts",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "receipts": {"type": "array",
+                             "items": _GROUP_RECEIPT_SCHEMA},
+            },
+            "required": ["receipts"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+# System prompts for single-document extraction requests
+IMAGE_SYSTEM_PROMPT = ("You are a document parser that extracts "
+                       "structured data from images.")
+PDF_SYSTEM_PROMPT = ("You are a document parser that extracts "
+                     "structured data from PDF documents.")
+
+# Number of uncached documents sent together in one extraction request
+EXTRACTION_GROUP_SIZE = 6
+
+# Vision model used for extraction
+EXTRACTION_MODEL = "gpt-4o"
+
+# Mixed into every cache key so that changing the model, prompt or image
+# preprocessing invalidates earlier extractions
+_CACHE_KEY_SALT = (
+    f"{EXTRACTION_MODEL}\n{MAX_IMAGE_DIMENSION}\n{EXTRACTION_PROMPT}\n"
+    f"{GROUP_EXTRACTION_PROMPT}"
+).encode('utf-8')
+
+# Filenames already taken in each renamed subfolder, see get_used_names()
+_used_names = {}
+
+# Vendor name cleanup patterns used when building filenames
+_BUSINESS_SUFFIXES = (' Inc', ' LLC', ' Ltd',
+                      ' Corp', ' Corporation', ' Company', ' Co')
+_NON_WORD = re.compile(r'[^\w\s-]')
+_HYPHENS = re.compile(r'[-\s]+')
+
+# Matches one "Field: value" line of the extracted receipt text
+_META_RE = re.compile(r'^(Vendor|Date|Total|Notes):[ \t]*(.*?)[ \t]*$',
+                      re.MULTILINE)
+
+
+@functools.lru_cache(maxsize=1024)
 def get_fiscal_quarter(date_str: str) -> str:
     """Determine the fiscal quarter based on the date string."""
-    try:
-        # Parse the date string - handle common formats
-        date_formats = [
-            "%B %d, %Y",  # May 29, 2025
-            "%b %d, %Y",  # May 29, 2025
-            "%m/%d/%Y",   # 05/29/2025
-            "%Y-%m-%d",   # 2025-05-29
-            "%d/%m/%Y",   # 29/05/2025
-        ]
-
-        parsed_date = None
-        for fmt in date_formats:
-            try:
-                parsed_date = datetime.strptime(date_str.strip(), fmt)
-                break
-            except ValueError:
-                continue
-
-        if parsed_date is None:
-            return "Unknown"
-
-        month = parsed_date.month
-
-        if month in [1, 2, 3]:
-            return "Q1"
-        elif month in [4, 5, 6]:
-            return "Q2"
-        elif month in [7, 8, 9]:
-            return "Q3"
-        elif month in [10, 11, 12]:
-            return "Q4"
-        else:
-            return "Unknown"
-
-    except Exception as e:
-        print(f"Error parsing date '{date_str}': {e}")
+    parsed_date = parse_receipt_date(date_str)
+    if parsed_date is None:
         return "Unknown"
 
+    return f"Q{(parsed_date.month - 1) // 3 + 1}"
+
 
+@functools.lru_cache(maxsize=1024)
 def parse_date_for_filename(date_str: str) -> tuple:
     """Parse date string and return month and year for filename."""
-    try:
-        # Parse the date string - handle common formats
-        date_formats = [
-            "%B %d, %Y",  # May 29, 2025
-            "%b %d, %Y",  # May 29, 2025
-            "%m/%d/%Y",   # 05/29/2025
-            "%Y-%m-%d",   # 2025-05-29
-            "%d/%m/%Y",   # 29/05/2025
-        ]
-
-        parsed_date = None
-        for fmt in date_formats:
-            try:
-                parsed_date = datetime.strptime(date_str.strip(), fmt)
-                break
-            except ValueError:
-                continue
+    parsed_date = parse_receipt_date(date_str)
+    if parsed_date is None:
+        return "08", "1619"  # Default fallback
 
-        if parsed_date is None:
-            return "08", "1619"  # Default fallback
-
-        return f"{parsed_date.month:02d}", str(parsed_date.year)
-
-    except Exception as e:
-        print(f"Error parsing date '{date_str}' for filename: {e}")
-        return "01", "2025"  # Default fallback
+    return f"{parsed_date.month:02d}", str(parsed_date.year)
 
 
+@functools.lru_cache(maxsize=1024)
 def sanitize_vendor_name(vendor_name: str) -> str:
     """Sanitize vendor name for use in filename."""
     # Remove common prefixes and clean up the name
     vendor = vendor_name.strip()
 
-    # Remove common business suffixes
-    suffixes_to_remove = [' Inc', ' LLC', ' Ltd',
-                          ' Corp', ' Corporation', ' Company', ' Co']
-    for suffix in suffixes_to_remove:
-        if vendor.endswith(suffix):
-            vendor = vendor[:-len(suffix)]
+    # Remove common business suffixes, checking them all in one call first
+    # since most vendor names have none
+    if vendor.endswith(_BUSINESS_SUFFIXES):
+        for suffix in _BUSINESS_SUFFIXES:
+            vendor = vendor.removesuffix(suffix)
 
     # Replace spaces and special characters with hyphens
     # Remove special chars except hyphens
-    vendor = re.sub(r'[^\w\s-]', '', vendor)
+    vendor = _NON_WORD.sub('', vendor)
     # Replace spaces and multiple hyphens with single hyphen
-    vendor = re.sub(r'[-\s]+', '-', vendor)
+    vendor = _HYPHENS.sub('-', vendor)
     # Remove leading/trailing hyphens
     vendor = vendor.strip('-')
 
@@ -139,6 +209,18 @@ def sanitize_vendor_name(vendor_name: str) -> str:
     return vendor
 
 
+def get_used_names(renamed_dir: str) -> set:
+    """Return the set of filenames taken in a renamed subfolder.
+
+    The folder is listed once per run; create_renamed_copy() adds each name
+    it allocates, so later collisions are checked without touching disk.
+    """
+    if renamed_dir not in _used_names:
+        with os.scandir(renamed_dir) as entries:
+            _used_names[renamed_dir] = {entry.name for entry in entries}
+    return _used_names[renamed_dir]
+
+
 def create_renamed_copy(file_path: str, vendor: str, fiscal_quarter: str,
                         date_str: str) -> str:
     """Create a copy of the document with the new naming template in a renamed subfolder."""
@@ -161,46 +243,95 @@ def create_renamed_copy(file_path: str, vendor: str, fiscal_quarter: str,
         # Create the renamed subfolder if it doesn't exist
         os.makedirs(renamed_dir, exist_ok=True)
 
-        # Create the new file path in the renamed subfolder
-        new_file_path = os.path.join(renamed_dir, new_filename)
-
         # Check if file already exists and add counter if needed
+        taken = get_used_names(renamed_dir)
+        name_without_ext, ext = os.path.splitext(new_filename)
         counter = 1
-        original_new_file_path = new_file_path
-        while os.path.exists(new_file_path):
-            name_without_ext = os.path.splitext(original_new_file_path)[0]
-            ext = os.path.splitext(original_new_file_path)[1]
-            new_file_path = (f"{name_without_ext}-{counter}{ext}")
+        while new_filename in taken:
+            new_filename = f"{name_without_ext}-{counter}{ext}"
             counter += 1
+        taken.add(new_filename)
+
+        # Create the new file path in the renamed subfolder
+        new_file_path = os.path.join(renamed_dir, new_filename)
 
-        # Copy the file to the renamed subfolder
-        shutil.copy2(file_path, new_file_path)
+        # Link or copy the file into the renamed subfolder
+        try:
+            link_or_copy(file_path, new_file_path, RENAMED_COPY_MODE)
+        except Exception:
+            taken.discard(new_filename)
+            raise
         return new_file_path
 
     except Exception as e:
-        print(f"Error creating renamed copy: {e}")
+        logger.warning(f"Error creating renamed copy: {e}")
         return None
 
 
-def extract_info_from_document(file_path: str) -> str:
-    """Send a document (image or PDF) to OpenAI's Vision API and return the extracted info."""
-    file_ext = os.path.splitext(file_path)[1].lower()
-
-    if file_ext in ['.pdf']:
-        # Handle PDF files
-        return extract_info_from_pdf(file_path)
-    elif file_ext in ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff']:
-        # Handle image files
-        return extract_info_from_image(file_path)
+def build_extraction_request(system_prompt: str, image_url: str) -> dict:
+    """Build the chat completion request body for a receipt image."""
+    return {
+        "model": EXTRACTION_MODEL,
+        "messages": [
+            {
+                "role": "system",
+                "content": system_prompt
+            },
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": EXTRACTION_PROMPT},
+                    {
+                        "type": "image_url",
+                        "image_url": {"url": image_url}
+                    }
+                ],
+            },
+        ],
+        "max_tokens": 300,
+        "response_format": RECEIPT_RESPONSE_FORMAT,
+    }
+
+
+def b64encode_str(data) -> str:
+    """Base64-encode bytes (or a memory map) into an ASCII string."""
+    if pybase64 is not None:
+        # SIMD-accelerated, and builds the str without an extra bytes copy
+        return pybase64.b64encode_as_string(data)
+    return base64.b64encode(data).decode('ascii')
+
+
+def downscale_image(image_path: str):
+    """Return the image re-encoded as JPEG bytes if it exceeds MAX_IMAGE_DIMENSION.
+
+    Returns None when the image is already small enough to send as-is.
+    """
+    with Image.open(image_path) as img:
+        if max(img.size) <= MAX_IMAGE_DIMENSION:
+            return None
+
+        # Apply the EXIF rotation, since it is lost when re-encoding
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((MAX_IMAGE_DIMENSION, MAX_IMAGE_DIMENSION),
+                      Image.LANCZOS)
+        buffer = io.BytesIO()
+        img.convert('RGB').save(buffer, 'JPEG', quality=85, optimize=True)
+        return buffer.getvalue()
+
+
+def build_image_url(image_path: str) -> str:
+    """Read an image file and return it as a base64 data URL."""
+    # Send large photos downscaled; the original file is left untouched
+    downscaled = downscale_image(image_path)
+    if downscaled is not None:
+        base64_image = b64encode_str(downscaled)
+        mime_type = "image/jpeg"
     else:
-        raise ValueError(f"Unsupported file type: {file_ext}")
-
-
-def extract_info_from_image(image_path: str) -> str:
-    """Send an image to OpenAI's Vision API and return the extracted info."""
-    with open(image_path, "rb") as img_file:
-        image_data = img_file.read()
-        base64_image = base64.b64encode(image_data).decode('utf-8')
+        # Encode straight from a memory map to avoid an extra copy of the file
+        with open(image_path, "rb") as img_file, \
+                mmap.mmap(img_file.fileno(), 0,
+                          access=mmap.ACCESS_READ) as mm:
+            base64_image = b64encode_str(mm)
 
         # Determine MIME type based on file extension
         file_ext = os.path.splitext(image_path)[1].lower()
@@ -217,215 +348,549 @@ def extract_info_from_image(image_path: str) -> str:
         else:
             mime_type = "image/jpeg"  # Default fallback
 
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {
-                    "role": "system",
-                    "content": ("You are a document parser that extracts "
-                                "structured data from images.")
-                },
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": EXTRACTION_PROMPT},
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": (f"data:{mime_type};base64,"
-                                        f"{base64_image}")
-                            }
-                        }
-                    ],
-                },
-            ],
-            max_tokens=300,
-        )
-        return response.choices[0].message.content.strip()
+    return f"data:{mime_type};base64,{base64_image}"
 
 
-def extract_info_from_pdf(pdf_path: str) -> str:
-    """Send a PDF to OpenAI's Vision API and return the extracted info."""
-    try:
-        # Open PDF and get first page
-        pdf_document = fitz.open(pdf_path)
-        if len(pdf_document) == 0:
+def build_pdf_image_url(pdf_path: str) -> str:
+    """Render the first page of a PDF and return it as a base64 data URL."""
+    # Imported here since PyMuPDF is slow to load and only needed for PDFs
+    import fitz  # PyMuPDF for PDF processing
+
+    # Open PDF and render its first page; the document is closed even if
+    # rendering fails
+    with fitz.open(pdf_path) as pdf_document:
+        try:
+            page = pdf_document.load_page(0)  # Process first page
+        except ValueError:
             raise ValueError("PDF file is empty or corrupted")
 
-        # Convert first page to image
-        page = pdf_document[0]  # Process first page
-        # 2x zoom for better quality
-        pix = page.get_pixmap(matrix=fitz.Matrix(2, 2))
-
-        # Convert to PNG bytes
-        png_bytes = pix.tobytes("png")
-
-        # Encode to base64
-        base64_image = base64.b64encode(png_bytes).decode('utf-8')
-
-        # Close the PDF document
-        pdf_document.close()
-
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {
-                    "role": "system",
-                    "content": ("You are a document parser that extracts "
-                                "structured data from PDF documents.")
-                },
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": EXTRACTION_PROMPT},
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/png;base64,{base64_image}"
-                            }
-                        }
-                    ],
-                },
-            ],
-            max_tokens=300,
-        )
-        return response.choices[0].message.content.strip()
+        # 1.5x zoom keeps receipt text legible at a fraction of the 2x size;
+        # long pages are rendered smaller so they fit MAX_IMAGE_DIMENSION
+        zoom = min(1.5, MAX_IMAGE_DIMENSION / max(page.rect.width,
+                                                  page.rect.height))
+        pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
 
-    except Exception as e:
-        raise Exception(f"Error processing PDF {pdf_path}: {e}")
+    # Encode straight to JPEG, which is far smaller than PNG for scans
+    jpeg_bytes = pix.tobytes("jpeg", jpg_quality=85)
 
+    # Encode to base64
+    base64_image = b64encode_str(jpeg_bytes)
 
-def process_receipts(folder: str):
-    """Process all supported document files in the folder and create corresponding .txt summaries."""
-    supported_extensions = ['.jpg', '.jpeg',
-                            '.png', '.gif', '.bmp', '.tiff', '.pdf']
+    return f"data:image/jpeg;base64,{base64_image}"
 
-    # Create renamed subfolder at the beginning
-    renamed_dir = os.path.join(folder, "renamed")
-    os.makedirs(renamed_dir, exist_ok=True)
-    print(f"Created/using renamed subfolder: {renamed_dir}")
 
-    # Prepare CSV data
-    csv_data = []
-    csv_headers = ['Original Filename',
-                   'Renamed Filename', 'Metadata Filename']
+def build_document_image_url(file_path: str) -> str:
+    """Return a document (image or PDF) as a base64 image data URL."""
+    file_ext = os.path.splitext(file_path)[1].lower()
 
-    for filename in os.listdir(folder):
-        file_ext = os.path.splitext(filename)[1].lower()
-        if file_ext in supported_extensions:
-            file_path = os.path.join(folder, filename)
-            print(f"Processing: {file_path}")
+    if file_ext == '.pdf':
+        return build_pdf_image_url(file_path)
+    elif file_ext in IMAGE_EXTENSIONS:
+        return build_image_url(file_path)
+    else:
+        raise ValueError(f"Unsupported file type: {file_ext}")
 
-            # Initialize CSV row data
-            csv_row = {
-                'Original Filename': filename,
-                'Renamed Filename': '',
-                'Metadata Filename': ''
-            }
 
+def build_document_extraction_request(file_path: str, image_url: str) -> dict:
+    """Build the extraction request body for an already encoded document."""
+    if os.path.splitext(file_path)[1].lower() == '.pdf':
+        return build_extraction_request(PDF_SYSTEM_PROMPT, image_url)
+    return build_extraction_request(IMAGE_SYSTEM_PROMPT, image_url)
+
+
+def build_group_extraction_request(image_urls: list) -> dict:
+    """Build one request body that extracts info from several documents."""
+    content = [{"type": "text",
+                "text": GROUP_EXTRACTION_PROMPT.format(count=len(image_urls))}]
+    for image_url in image_urls:
+        content.append({"type": "image_url", "image_url": {"url": image_url}})
+
+    return {
+        "model": EXTRACTION_MODEL,
+        "messages": [
+            {
+                "role": "system",
+                "content": ("You are a document parser that extracts "
+                            "structured data from receipt images.")
+            },
+            {"role": "user", "content": content},
+        ],
+        "max_tokens": 300 * len(image_urls),
+        "response_format": GROUP_RESPONSE_FORMAT,
+    }
+
+
+def format_extracted_fields(receipt: dict) -> str:
+    """Render a structured receipt reply as "Field: value" lines."""
+    lines = []
+    for field in ('Vendor', 'Date', 'Total', 'Notes'):
+        value = receipt.get(field.lower())
+        if value is not None and str(value).strip():
+            lines.append(f"{field}: {str(value).strip()}")
+    return '\n'.join(lines)
+
+
+def parse_extraction(response_text: str) -> str:
+    """Convert a structured extraction reply into extracted text."""
+    # Refusals come back with no content instead of a receipt
+    if response_text is None:
+        raise ValueError("Extraction request was refused")
+    receipt = json_loads(response_text)
+    if not isinstance(receipt, dict):
+        raise ValueError(f"Unexpected extraction reply: {response_text!r}")
+    return format_extracted_fields(receipt)
+
+
+def parse_group_extraction(response_text: str, count: int):
+    """Convert a grouped extraction reply into per-document extracted text.
+
+    Entries are matched to documents by their idx field. Returns None unless
+    the reply holds exactly one receipt for each idx from 0 to count - 1.
+    """
+    if response_text is None:
+        return None
+    try:
+        reply = json_loads(response_text)
+    except ValueError:
+        return None
+    receipts = reply.get("receipts") if isinstance(reply, dict) else None
+    if (not isinstance(receipts, list) or len(receipts) != count or
+            not all(isinstance(receipt, dict) for receipt in receipts)):
+        return None
+
+    by_index = {}
+    for receipt in receipts:
+        idx = receipt.get("idx")
+        if type(idx) is not int or not 0 <= idx < count or idx in by_index:
+            return None
+        by_index[idx] = receipt
+
+    return [format_extracted_fields(by_index[idx]) for idx in range(count)]
+
+
+async def extract_info_from_documents(file_paths: list,
+                                      semaphore: asyncio.Semaphore) -> list:
+    """Extract info for several documents, sending them in one request.
+
+    Falls back to one request per document if the grouped request fails or
+    its reply can't be matched to the documents. Returns the extracted text,
+    or the exception raised, for each document in order.
+    """
+    async with semaphore:
+        # Encode only once a request slot is free, so that waiting groups
+        # don't hold their images in memory. Encoding runs off the event
+        # loop, and an unreadable document fails on its own without keeping
+        # the rest from being grouped
+        results = await asyncio.gather(
+            *(asyncio.to_thread(build_document_image_url, file_path)
+              for file_path in file_paths),
+            return_exceptions=True
+        )
+        readable = [index for index, result in enumerate(results)
+                    if not isinstance(result, Exception)]
+        image_urls = {index: results[index] for index in readable}
+
+        if len(readable) > 1:
             try:
-                extracted_text = extract_info_from_document(file_path)
-
-                # Parse the extracted text to add fiscal quarter
-                lines = extracted_text.split('\n')
-                date_line = None
-                vendor_line = None
-                total_line = None
-                notes_line = None
-
-                for line in lines:
-                    if line.startswith('Date:'):
-                        date_line = line
-                    elif line.startswith('Vendor:'):
-                        vendor_line = line
-                    elif line.startswith('Total:'):
-                        total_line = line
-                    elif line.startswith('Notes:'):
-                        notes_line = line
-
-                # Extract date for fiscal quarter calculation
-                if date_line:
-                    date_str = date_line.replace('Date:', '').strip()
-                    fiscal_quarter = get_fiscal_quarter(date_str)
-                else:
-                    fiscal_quarter = "Unknown"
-
-                # Extract vendor name
-                vendor_name = "Unknown-Vendor"
-                if vendor_line:
-                    vendor_name = vendor_line.replace('Vendor:', '').strip()
-
-                # Reconstruct the output with fiscal quarter
-                output_lines = []
-                if vendor_line:
-                    output_lines.append(vendor_line)
-                if date_line:
-                    output_lines.append(date_line)
-                output_lines.append(f"Fiscal Quarter: {fiscal_quarter}")
-                if total_line:
-                    output_lines.append(total_line)
-                if notes_line:
-                    output_lines.append(notes_line)
-
-                # If parsing failed, use original extracted text and add fiscal quarter
-                if not output_lines:
-                    output_lines = lines
-                    if date_line:
-                        date_str = date_line.replace('Date:', '').strip()
-                        fiscal_quarter = get_fiscal_quarter(date_str)
-                        # Insert fiscal quarter after date
-                        for i, line in enumerate(output_lines):
-                            if line.startswith('Date:'):
-                                output_lines.insert(
-                                    i + 1, f"Fiscal Quarter: {fiscal_quarter}")
-                                break
-
-                final_output = '\n'.join(output_lines)
-
-                txt_path = os.path.splitext(file_path)[0] + ".txt"
-                metadata_filename = os.path.basename(txt_path)
-                with open(txt_path, "w") as txt_file:
-                    txt_file.write(final_output)
-                print(f"Saved extracted data to {txt_path}")
-
-                # Update CSV row with metadata filename
-                csv_row['Metadata Filename'] = metadata_filename
-
-                # Create renamed copy of the document
-                if date_line:
-                    date_str = date_line.replace('Date:', '').strip()
-                    new_file_path = create_renamed_copy(
-                        file_path, vendor_name, fiscal_quarter, date_str)
-                    if new_file_path:
-                        renamed_filename = os.path.basename(new_file_path)
-                        print(f"Created renamed copy: {renamed_filename}")
-                        # Update CSV row with renamed filename
-                        csv_row['Renamed Filename'] = renamed_filename
-                    else:
-                        print("Failed to create renamed copy")
-                        csv_row['Renamed Filename'] = 'Failed'
-                else:
-                    print("No date found, skipping renamed copy creation")
-                    csv_row['Renamed Filename'] = 'No Date'
+                request = build_group_extraction_request(
+                    [image_urls[index] for index in readable])
+                response = await get_async_client().chat.completions.create(
+                    **request)
+                extracted = parse_group_extraction(
+                    response.choices[0].message.content, len(readable))
+                if extracted is not None:
+                    for index, extracted_text in zip(readable, extracted):
+                        results[index] = extracted_text
+                    return results
+                logger.warning(f"Unexpected reply for {len(readable)} grouped "
+                               f"documents, sending them one at a time")
+            except Exception as e:
+                logger.warning(f"Grouped extraction failed ({e}), sending "
+                               f"{len(readable)} documents one at a time")
+
+    async def extract_one(index):
+        # Reuse the image already encoded for the grouped request
+        request = build_document_extraction_request(file_paths[index],
+                                                    image_urls[index])
+        async with semaphore:
+            response = await get_async_client().chat.completions.create(
+                **request)
+        return parse_extraction(response.choices[0].message.content)
+
+    extracted = await asyncio.gather(
+        *(extract_one(index) for index in readable),
+        return_exceptions=True
+    )
+    for index, result in zip(readable, extracted):
+        results[index] = result
+    return results
+
 
+def json_dumps_bytes(obj) -> bytes:
+    """Serialize an object to JSON bytes, using orjson when available."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode('utf-8')
+
+
+def json_loads(data):
+    """Parse JSON bytes or text, using orjson when available."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+async def submit_batch(file_paths: list, folder: str) -> dict:
+    """Run extraction for all documents through the OpenAI Batch API.
+
+    Returns a mapping of original filename to extracted text. Documents whose
+    request failed inside the batch are left out of the mapping.
+    """
+    client = get_async_client()
+
+    # Build one JSONL line per document, keyed by its filename
+    batch_input_path = os.path.join(folder, "batch_requests.jsonl")
+    with open(batch_input_path, "wb") as batch_file:
+        for file_path in file_paths:
+            try:
+                request = build_document_extraction_request(
+                    file_path, build_document_image_url(file_path))
             except Exception as e:
-                print(f"Failed to process {filename}: {e}")
-                csv_row['Renamed Filename'] = 'Error'
-                csv_row['Metadata Filename'] = 'Error'
+                logger.error(f"Failed to prepare {file_path} for batch: {e}")
+                continue
+            batch_file.write(json_dumps_bytes({
+                "custom_id": os.path.basename(file_path),
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": request,
+            }) + b"\n")
+
+    with open(batch_input_path, "rb") as batch_file:
+        input_file = await client.files.create(file=batch_file,
+                                               purpose="batch")
+    batch = await client.batches.create(
+        input_file_id=input_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+    )
+    print(f"Submitted batch {batch.id} with {len(file_paths)} requests")
+
+    # Poll until the batch reaches a terminal state
+    while batch.status not in BATCH_TERMINAL_STATUSES:
+        await asyncio.sleep(BATCH_POLL_INTERVAL_SECONDS)
+        batch = await client.batches.retrieve(batch.id)
+        print(f"Batch {batch.id} status: {batch.status}")
+
+    if batch.status != "completed":
+        raise RuntimeError(f"Batch {batch.id} ended with status "
+                           f"'{batch.status}'")
+
+    extracted = {}
+    if not batch.output_file_id:
+        return extracted
+
+    output = await client.files.content(batch.output_file_id)
+    for line in output.content.splitlines():
+        if not line.strip():
+            continue
+        result = json_loads(line)
+        response = result.get("response") or {}
+        if result.get("error") or response.get("status_code") != 200:
+            logger.error(f"Batch request failed for {result['custom_id']}: "
+                         f"{result.get('error') or response.get('body')}")
+            continue
+        content = response["body"]["choices"][0]["message"]["content"]
+        try:
+            extracted[result["custom_id"]] = parse_extraction(content)
+        except ValueError as e:
+            logger.error(f"Batch request failed for {result['custom_id']}: "
+                         f"{e}")
+
+    return extracted
+
+
+def file_digest(file_path: str) -> str:
+    """Return a content hash for a document, used as its cache key."""
+    digest = hashlib.blake2b(_CACHE_KEY_SALT, digest_size=16)
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def load_extraction_cache(cache_path: str) -> dict:
+    """Load the content hash to extracted text manifest."""
+    if not os.path.exists(cache_path):
+        return {}
+    try:
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except Exception as e:
+        logger.warning(f"Ignoring unreadable cache {cache_path}: {e}")
+        return {}
+
+
+def save_extraction_cache(cache_path: str, cache: dict):
+    """Atomically write the content hash to extracted text manifest."""
+    tmp_path = cache_path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(cache, f)
+    os.replace(tmp_path, cache_path)
+
+
+def lookup_cached_extraction(file_path: str, cache: dict) -> tuple:
+    """Find previously extracted text for a document without calling the API.
+
+    Returns the document's content hash and the cached text (or None on a
+    miss). The hash covers the model, prompts and preprocessing settings, so
+    changing any of them is a miss.
+    """
+    digest = file_digest(file_path)
+    return digest, cache.get(digest)
+
+
+def error_row(filename: str) -> SummaryRow:
+    """Create the summary CSV row for a document that failed to process."""
+    return SummaryRow(filename, 'Error', 'Error')
+
+
+def save_extracted_info(file_path: str, extracted_text: str) -> SummaryRow:
+    """Write the metadata file and renamed copy for a document's extracted info.
+
+    Returns the document's summary CSV row.
+    """
+    # Parse the extracted text to add fiscal quarter
+    fields = {match.group(1): match
+              for match in _META_RE.finditer(extracted_text)}
+    date_match = fields.get('Date')
+    vendor_match = fields.get('Vendor')
 
-            # Add the row to CSV data
-            csv_data.append(csv_row)
+    # Extract date for fiscal quarter calculation
+    if date_match:
+        date_str = date_match.group(2)
+        fiscal_quarter = get_fiscal_quarter(date_str)
+    else:
+        fiscal_quarter = "Unknown"
+
+    # Extract vendor name
+    vendor_name = "Unknown-Vendor"
+    if vendor_match:
+        vendor_name = vendor_match.group(2)
+
+    # Reconstruct the output with fiscal quarter
+    output_lines = []
+    if vendor_match:
+        output_lines.append(vendor_match.group(0))
+    if date_match:
+        output_lines.append(date_match.group(0))
+    output_lines.append(f"Fiscal Quarter: {fiscal_quarter}")
+    for field in ('Total', 'Notes'):
+        if field in fields:
+            output_lines.append(fields[field].group(0))
+
+    final_output = '\n'.join(output_lines)
+
+    txt_path = os.path.splitext(file_path)[0] + ".txt"
+    metadata_filename = os.path.basename(txt_path)
+    with open(txt_path, "w") as txt_file:
+        txt_file.write(final_output)
+    logger.info(f"Saved extracted data to {txt_path}")
+
+    # Create renamed copy of the document
+    if date_match:
+        new_file_path = create_renamed_copy(
+            file_path, vendor_name, fiscal_quarter, date_str)
+        if new_file_path:
+            renamed_filename = os.path.basename(new_file_path)
+            logger.info(f"Created renamed copy: {renamed_filename}")
+        else:
+            logger.warning("Failed to create renamed copy")
+            renamed_filename = 'Failed'
+    else:
+        logger.warning("No date found, skipping renamed copy creation")
+        renamed_filename = 'No Date'
+
+    return SummaryRow(os.path.basename(file_path), renamed_filename,
+                      metadata_filename)
+
+
+def finish_receipt(file_path: str, extracted_text: str) -> SummaryRow:
+    """Save a document's extracted info and return its summary CSV row."""
+    filename = os.path.basename(file_path)
+    logger.info(f"Processing: {file_path}")
+
+    try:
+        return save_extracted_info(file_path, extracted_text)
+
+    except Exception as e:
+        logger.error(f"Failed to process {filename}: {e}")
+        return error_row(filename)
+
+
+async def process_receipts_batch(file_paths: list, folder: str,
+                                 cache: dict, cache_path: str, writer):
+    """Extract metadata for all documents via the Batch API and write their rows."""
+    # Only submit documents that have no cached extraction
+    extracted = {}
+    digests = {}
+    for file_path in file_paths:
+        filename = os.path.basename(file_path)
+        try:
+            digest, extracted_text = lookup_cached_extraction(file_path, cache)
+        except Exception as e:
+            logger.error(f"Failed to check cache for {filename}: {e}")
+            continue
+        if extracted_text is not None:
+            logger.info(f"Using cached extraction for {filename}")
+            extracted[filename] = extracted_text
+        else:
+            digests[filename] = digest
+
+    if digests:
+        pending = [file_path for file_path in file_paths
+                   if os.path.basename(file_path) in digests]
+        batch_results = await submit_batch(pending, folder)
+        for filename, extracted_text in batch_results.items():
+            cache[digests[filename]] = extracted_text
+        save_extraction_cache(cache_path, cache)
+        extracted.update(batch_results)
+
+    for file_path in file_paths:
+        filename = os.path.basename(file_path)
+        if filename not in extracted:
+            logger.error(f"Failed to process {filename}: "
+                         f"No result returned by batch")
+            writer.writerow(error_row(filename))
+            continue
+
+        writer.writerow(finish_receipt(file_path, extracted[filename]))
+
+
+async def write_receipt_rows(file_paths: list, cache: dict, cache_path: str,
+                             writer):
+    """Process documents concurrently and write their CSV rows in order.
+
+    Uncached documents are sent EXTRACTION_GROUP_SIZE at a time. Each row is
+    written as soon as every earlier document has finished.
+    """
+    # Overlap the Vision API round-trips, bounded by the semaphore
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+    # Rows that finished ahead of an earlier, still in-flight document
+    finished = {}
+    next_row = 0
+
+    def write_ready_rows():
+        """Write rows, in order, up to the first one still in flight."""
+        nonlocal next_row
+        while next_row in finished:
+            writer.writerow(finished.pop(next_row))
+            next_row += 1
+
+    # Only send documents that have no cached extraction
+    lookups = await asyncio.gather(
+        *(asyncio.to_thread(lookup_cached_extraction, file_path, cache)
+          for file_path in file_paths),
+        return_exceptions=True
+    )
+    digests = {}
+    for index, (file_path, lookup) in enumerate(zip(file_paths, lookups)):
+        filename = os.path.basename(file_path)
+        if isinstance(lookup, Exception):
+            logger.error(f"Failed to process {filename}: {lookup}")
+            finished[index] = error_row(filename)
+            continue
+        digest, extracted_text = lookup
+        if extracted_text is not None:
+            logger.info(f"Using cached extraction for {filename}")
+            finished[index] = finish_receipt(file_path, extracted_text)
+        else:
+            digests[index] = digest
+    write_ready_rows()
+
+    async def process_group(indexes):
+        results = await extract_info_from_documents(
+            [file_paths[index] for index in indexes], semaphore)
+        rows = {}
+        for index, result in zip(indexes, results):
+            file_path = file_paths[index]
+            if isinstance(result, Exception):
+                filename = os.path.basename(file_path)
+                logger.error(f"Failed to process {filename}: {result}")
+                rows[index] = error_row(filename)
+                continue
+            cache[digests[index]] = result
+            rows[index] = finish_receipt(file_path, result)
+        save_extraction_cache(cache_path, cache)
+        return rows
 
-    # Write CSV file
+    pending = list(digests)
+    groups = [process_group(pending[i:i + EXTRACTION_GROUP_SIZE])
+              for i in range(0, len(pending), EXTRACTION_GROUP_SIZE)]
+    for group in asyncio.as_completed(groups):
+        finished.update(await group)
+        write_ready_rows()
+
+
+async def process_receipts(folder: str, use_batch: bool = False):
+    """Process all supported document files in the folder and create corresponding .txt summaries."""
+    # Create renamed subfolder at the beginning
+    renamed_dir = os.path.join(folder, "renamed")
+    os.makedirs(renamed_dir, exist_ok=True)
+    print(f"Created/using renamed subfolder: {renamed_dir}")
+
+    # Only top-level files are listed, so renamed/ copies are never
+    # picked up again on re-runs
+    with os.scandir(folder) as entries:
+        file_paths = [entry.path for entry in entries
+                      if entry.is_file() and
+                      entry.name.lower().endswith(SUPPORTED_EXTENSIONS)]
+    # scandir order is arbitrary; keep the summary CSV ordered by filename
+    file_paths.sort()
+
+    cache_path = os.path.join(folder, CACHE_FILENAME)
+    cache = load_extraction_cache(cache_path)
+
+    # Write CSV rows as receipts finish, instead of all at the end
     csv_filename = os.path.join(folder, "receipts_processing_summary.csv")
-    with open(csv_filename, 'w', newline='', encoding='utf-8') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=csv_headers)
-        writer.writeheader()
-        writer.writerows(csv_data)
+    with open(csv_filename, 'w', newline='', encoding='utf-8',
+              buffering=CSV_BUFFER_SIZE) as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(SUMMARY_CSV_HEADERS)
+
+        if use_batch:
+            await process_receipts_batch(file_paths, folder, cache,
+                                         cache_path, writer)
+        else:
+            await write_receipt_rows(file_paths, cache, cache_path, writer)
 
     print(f"\nCSV summary created: {csv_filename}")
-    print(f"Processed {len(csv_data)} files")
+    print(f"Processed {len(file_paths)} files")
+
+
+async def main(use_batch: bool):
+    """Process the receipts folder, then close the HTTP connection pool."""
+    # Fail fast if the API key is missing
+    get_async_client()
+    try:
+        await process_receipts(FOLDER_PATH, use_batch=use_batch)
+    finally:
+        await close_async_client()
 
 
 if __name__ == "__main__":
-    process_receipts(FOLDER_PATH)
+    logging.basicConfig(format="%(message)s", stream=sys.stdout)
+    logger.setLevel(logging.INFO)
+
+    # Check command line arguments
+    use_batch = "--batch" in sys.argv
+    for arg in sys.argv[1:]:
+        if arg.startswith("--copy-mode="):
+            RENAMED_COPY_MODE = arg.split("=", 1)[1]
+            if RENAMED_COPY_MODE not in COPY_MODES:
+                print(f"Error: --copy-mode must be one of "
+                      f"{', '.join(COPY_MODES)}")
+                sys.exit(1)
+    if use_batch:
+        print("Mode: OpenAI Batch API (results may take up to 24h)")
+    asyncio.run(main(use_batch))
@@ -0,0 +1,73 @@
+"""
+Receipt date parsing shared by the BFF PCEF Expense Reporter scripts. Dates
+are recognized with a single precompiled regex instead of trying a list of
+strptime formats.
+"""
+
+import re
+from datetime import date
+
+# Dates accepted from the extracted receipt text: "May 29, 2025",
+# "05/29/2025" (or "29/05/2025" when the first number can't be a month)
+# and "2025-05-29" or "2025/05/29". Each date must stand alone, so no part
+# of a longer number (e.g. "25/05/29" in "2025/05/29") is taken as a date.
+_DATE_RE = re.compile(
+    r'(?:(?<![A-Za-z])(?P<mname>[A-Za-z]+)\.?\s+(?P<d1>\d{1,2}),?\s+'
+    r'(?P<y1>\d{4})(?!\d))'
+    r'|(?:(?<!\d)(?P<m2>\d{1,2})[/-](?P<d2>\d{1,2})[/-](?P<y2>\d{2,4})'
+    r'(?!\d))'
+    r'|(?:(?<!\d)(?P<y3>\d{4})[/-](?P<m3>\d{1,2})[/-](?P<d3>\d{1,2})'
+    r'(?!\d))'
+)
+_MONTH_NAMES = {
+    'january': 1, 'february': 2, 'march': 3, 'april': 4, 'may': 5,
+    'june': 6, 'july': 7, 'august': 8, 'september': 9, 'october': 10,
+    'november': 11, 'december': 12,
+    'jan': 1, 'feb': 2, 'mar': 3, 'apr': 4, 'jun': 6, 'jul': 7, 'aug': 8,
+    'sep': 9, 'sept': 9, 'oct': 10, 'nov': 11, 'dec': 12,
+}
+
+
+def _date_from_match(match):
+    """Build a date from a _DATE_RE match, or None if it is not a real date."""
+    if match.group('mname'):
+        month = _MONTH_NAMES.get(match.group('mname').lower())
+        if month is None:
+            return None
+        day, year = int(match.group('d1')), int(match.group('y1'))
+    elif match.group('m2'):
+        month, day = int(match.group('m2')), int(match.group('d2'))
+        year = int(match.group('y2'))
+        # Handle 2-digit years
+        if year < 100:
+            year += 2000
+        # Fall back to day-first when the first number can't be a month
+        if month > 12:
+            month, day = day, month
+    else:
+        year, month = int(match.group('y3')), int(match.group('m3'))
+        day = int(match.group('d3'))
+
+    try:
+        return date(year, month, day)
+    except ValueError:
+        return None
+
+
+def parse_receipt_date(date_str: str):
+    """Parse a receipt date string into a date, or None if unrecognized."""
+    match = _DATE_RE.fullmatch(date_str.strip())
+    if match is None:
+        return None
+
+    return _date_from_match(match)
+
+
+def find_receipt_date(text: str):
+    """Return the first recognizable date within text, or None."""
+    for match in _DATE_RE.finditer(text):
+        parsed_date = _date_from_match(match)
+        if parsed_date is not None:
+            return parsed_date
+
+    return None